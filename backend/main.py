@@ -5,19 +5,62 @@ Implements AG-UI protocol for agent-user interaction
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, AsyncIterator
-import ollama
-import json
+from typing_extensions import TypedDict
+from ollama import AsyncClient
+import httpx
+import orjson
 import asyncio
+import os
+import re
+import time
+import ahocorasick
 from datetime import datetime, timezone
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import sys
 
-app = FastAPI(title="AG-UI POC Backend")
+app = FastAPI(title="AG-UI POC Backend", default_response_class=ORJSONResponse)
 
-# Force print statements to flush immediately
-sys.stdout.reconfigure(line_buffering=True)
+# Shared async Ollama client so streaming doesn't block the event loop.
+# One pooled connection set for all requests; no read timeout since
+# generations can legitimately pause for a long time between tokens.
+_client = AsyncClient(
+    host=os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434"),
+    timeout=httpx.Timeout(None, connect=5.0),
+    limits=httpx.Limits(max_connections=1024, max_keepalive_connections=256),
+)
+
+# Token coalescing: emit a text_message after this many tokens, or once the
+# oldest buffered token has waited this many seconds
+COALESCE_MAX_TOKENS = 8
+COALESCE_MAX_DELAY = 0.02
+
+# Cap concurrent generations sent to Ollama (match Ollama's OLLAMA_NUM_PARALLEL)
+_OLLAMA_SEM = asyncio.Semaphore(int(os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+
+# Application logger; per-chunk detail is only formatted at DEBUG level.
+# Set LOG_LEVEL=DEBUG to see chunks, message dumps and event sends.
+logger = logging.getLogger("agui")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+class _DeferredQueueHandler(QueueHandler):
+    """Enqueue records unformatted so formatting happens on the listener thread"""
+    def prepare(self, record):
+        return record
+
+# Handlers run on a background thread; logging calls in the event loop only enqueue
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_queue = queue.SimpleQueue()
+logger.addHandler(_DeferredQueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # CORS configuration for frontend communication
 app.add_middleware(
@@ -29,7 +72,7 @@ app.add_middleware(
 )
 
 # Request/Response Models
-class Message(BaseModel):
+class Message(TypedDict):
     role: str
     content: str
 
@@ -37,12 +80,61 @@ class ChatRequest(BaseModel):
     messages: List[Message]
     model: Optional[str] = "mistral:latest"
 
+# Documents the wire format only; create_agui_event encodes events directly
+# with orjson and never instantiates this model
 class AGUIEvent(BaseModel):
     """AG-UI Protocol Event Structure"""
     type: str
     data: dict
     timestamp: Optional[str] = None
 
+# Color keywords for UI theme control, longest first so "light orange" beats "orange"
+COLOR_KEYWORDS: tuple[tuple[str, str], ...] = tuple(sorted({
+    "light orange": "#FFB347",
+    "light green": "#90EE90",
+    "light blue": "#87CEEB",
+    "light red": "#FF6B6B",
+    "light purple": "#DDA0DD",
+    "light pink": "#FFB6C1",
+    "light yellow": "#FFFFE0",
+    "dark green": "#006400",
+    "dark blue": "#00008B",
+    "dark red": "#8B0000",
+    "dark purple": "#4B0082",
+    "dark orange": "#FF8C00",
+    "green": "#22c55e",
+    "blue": "#646cff",
+    "red": "#ef4444",
+    "purple": "#a855f7",
+    "orange": "#f97316",
+    "pink": "#ec4899",
+    "yellow": "#eab308",
+    "cyan": "#06b6d4",
+    "teal": "#14b8a6",
+}.items(), key=lambda kv: -len(kv[0])))
+
+# Built once at import; a single linear scan finds every keyword in a message
+COLOR_AUTOMATON = ahocorasick.Automaton()
+for _keyword, _code in COLOR_KEYWORDS:
+    COLOR_AUTOMATON.add_word(_keyword, (_keyword, _code))
+COLOR_AUTOMATON.make_automaton()
+
+HAS_COLOR = re.compile(r'\bcolor')
+
+# Long messages (pasted text, context) are never treated as color commands
+COLOR_MAX_MESSAGE_LENGTH = 1024
+
+# Cheap case-insensitive pre-filter: only messages mentioning these can be UI requests
+_UI_HINT = re.compile(r'color|button', re.I)
+
+# Button intent: "button(s)" plus any form of "add"/"create", in either order
+_BUTTON_WORD = re.compile(r'\bbuttons?\b')
+_BUTTON_VERB = re.compile(r'\b(?:add|creat)\w*')
+
+# Button label extraction patterns
+_QUOTED = re.compile(r'["\']([^"\']+)["\']')
+_BUTTON_NAMED = re.compile(r'button (?:called|named) (\w+)')
+
 # AG-UI Protocol Event Types
 class EventType:
     TEXT_MESSAGE = "text_message"
@@ -51,101 +143,110 @@ class EventType:
     ERROR = "error"
     START = "start"
     END = "end"
+    UI_CONTROL = "ui_control"
 
-def create_agui_event(event_type: str, data: dict) -> str:
-    """Create AG-UI protocol compliant event"""
-    event = AGUIEvent(
-        type=event_type,
-        data=data,
-        timestamp=datetime.utcnow().isoformat()
+# Static SSE envelope prefix per event type; only data and timestamp vary
+_EVENT_PREFIXES = {
+    event_type: b'data: {"type":' + orjson.dumps(event_type) + b',"data":'
+    for event_type in (
+        EventType.TEXT_MESSAGE,
+        EventType.AGENT_STATE,
+        EventType.RESULT,
+        EventType.ERROR,
+        EventType.START,
+        EventType.END,
+        EventType.UI_CONTROL,
     )
-    return f"data: {json.dumps(event.dict())}\n\n"
+}
+
+# Last (millisecond bucket, ISO string) pair; events within the same millisecond share it
+_ts_cache = [0, ""]
+
+def _iso_now() -> str:
+    """Return the current UTC time as ISO 8601, cached at 1 ms granularity"""
+    now = time.time()
+    ms = int(now * 1000)
+    if ms != _ts_cache[0]:
+        _ts_cache[0] = ms
+        _ts_cache[1] = datetime.fromtimestamp(now, timezone.utc).isoformat()
+    return _ts_cache[1]
+
+def create_agui_event(event_type: str, data: dict) -> bytes:
+    """Create AG-UI protocol compliant event"""
+    prefix = _EVENT_PREFIXES.get(event_type)
+    if prefix is None:
+        prefix = b'data: {"type":' + orjson.dumps(event_type) + b',"data":'
+    return prefix + orjson.dumps(data) + b',"timestamp":"' + _iso_now().encode() + b'"}\n\n'
 
-async def stream_ollama_response(messages: List[Message], model: str) -> AsyncIterator[str]:
-    """Stream responses from Ollama with AG-UI protocol events"""
+def _text_message_event(buf: List[str]) -> bytes:
+    """Create one text_message delta event from buffered tokens"""
+    return create_agui_event(EventType.TEXT_MESSAGE, {
+        "content": "".join(buf),
+        "delta": True,
+        "role": "assistant"
+    })
+
+async def stream_ollama_response(messages: List[Message], model: str, include_result: bool = True) -> AsyncIterator[bytes]:
+    """Stream responses from Ollama with AG-UI protocol events
+
+    When include_result is False the final RESULT event is skipped and the
+    response text is not kept in memory.
+    """
     
-    print(f"🔵 [STREAM] Starting stream for model: {model}", flush=True)
-    print(f"🔵 [STREAM] Messages count: {len(messages)}", flush=True)
+    logger.debug("🔵 [STREAM] Starting stream for model: %s", model)
     
     # Check if user is requesting a UI change (color change)
     color_changed = False
     detected_color = ""
-    if messages:
-        last_message = messages[-1].content.lower()
+    # Skip lowercasing and the UI scans entirely for plain chat messages
+    if messages and _UI_HINT.search(messages[-1]["content"]):
+        last_message = messages[-1]["content"].lower()
         
-        # Simple color detection
-        color_keywords = {
-            "light orange": "#FFB347",
-            "light green": "#90EE90",
-            "light blue": "#87CEEB",
-            "light red": "#FF6B6B",
-            "light purple": "#DDA0DD",
-            "light pink": "#FFB6C1",
-            "light yellow": "#FFFFE0",
-            "dark green": "#006400",
-            "dark blue": "#00008B",
-            "dark red": "#8B0000",
-            "dark purple": "#4B0082",
-            "dark orange": "#FF8C00",
-            "green": "#22c55e",
-            "blue": "#646cff",
-            "red": "#ef4444",
-            "purple": "#a855f7",
-            "orange": "#f97316",
-            "pink": "#ec4899",
-            "yellow": "#eab308",
-            "cyan": "#06b6d4",
-            "teal": "#14b8a6",
-        }
+        # Simple color detection: one automaton pass, longest keyword wins
+        color_match = None
+        if len(last_message) <= COLOR_MAX_MESSAGE_LENGTH and HAS_COLOR.search(last_message):
+            color_match = max(
+                (value for _, value in COLOR_AUTOMATON.iter(last_message)),
+                key=lambda kv: len(kv[0]),
+                default=None,
+            )
         
-        for keyword, color_code in color_keywords.items():
-            if "color" in last_message and keyword in last_message:
-                print(f"🎨 [UI_CONTROL] Color change detected: {keyword} -> {color_code}", flush=True)
-                # Send UI control event BEFORE the text response
-                ui_control_event = json.dumps({
-                    "type": "ui_control",
-                    "data": {
-                        "action": "change_theme",
-                        "color": color_code
-                    },
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }) + "\n\n"
-                yield f"data: {ui_control_event}"
-                color_changed = True
-                detected_color = keyword
-                
-                # Add a system message to tell the AI it changed the color
-                messages.append(Message(
-                    role="system",
-                    content=f"[SYSTEM: You have successfully changed the UI color to {keyword}. Acknowledge this change briefly and naturally in your response.]"
-                ))
-                break
+        if color_match:
+            keyword, color_code = color_match
+            logger.info("🎨 [UI_CONTROL] Color change detected: %s -> %s", keyword, color_code)
+            # Send UI control event BEFORE the text response
+            yield create_agui_event(EventType.UI_CONTROL, {
+                "action": "change_theme",
+                "color": color_code
+            })
+            color_changed = True
+            detected_color = keyword
+            
+            # Add a system message to tell the AI it changed the color
+            messages.append(Message(
+                role="system",
+                content=f"[SYSTEM: You have successfully changed the UI color to {keyword}. Acknowledge this change briefly and naturally in your response.]"
+            ))
         
         # Check for button addition request
-        if ("add" in last_message or "create" in last_message) and "button" in last_message:
+        if _BUTTON_WORD.search(last_message) and _BUTTON_VERB.search(last_message):
             # Extract button label - look for quoted text or common patterns
             button_label = "Test"  # Default
             
             # Try to find quoted text
-            import re
-            quotes_match = re.search(r'["\']([^"\']+)["\']', messages[-1].content)
+            quotes_match = _QUOTED.search(messages[-1]["content"])
             if quotes_match:
                 button_label = quotes_match.group(1)
             # Or look for "button called X" or "button named X"
-            elif match := re.search(r'button (?:called|named) (\w+)', last_message):
+            elif match := _BUTTON_NAMED.search(last_message):
                 button_label = match.group(1).capitalize()
             
-            print(f"🔘 [UI_CONTROL] Button addition detected: {button_label}", flush=True)
+            logger.info("🔘 [UI_CONTROL] Button addition detected: %s", button_label)
             # Send UI control event to add button
-            ui_control_event = json.dumps({
-                "type": "ui_control",
-                "data": {
-                    "action": "add_button",
-                    "label": button_label
-                },
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            }) + "\n\n"
-            yield f"data: {ui_control_event}"
+            yield create_agui_event(EventType.UI_CONTROL, {
+                "action": "add_button",
+                "label": button_label
+            })
             
             # Add system message
             messages.append(Message(
@@ -158,78 +259,119 @@ async def stream_ollama_response(messages: List[Message], model: str) -> AsyncIt
         "agent": "ollama",
         "model": model
     })
-    print(f"📤 [EVENT] Sending START event: {start_event[:100]}...", flush=True)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📤 [EVENT] Sending START event: %s...", start_event[:100].decode(errors="replace"))
     yield start_event
     
+    # Tokens received but not yet sent; flushed on error so none are lost
+    buf: List[str] = []
+    
     try:
-        # Convert messages to Ollama format
-        ollama_messages = [
-            {"role": msg.role, "content": msg.content}
-            for msg in messages
-        ]
+        # Messages are already plain dicts in Ollama format
+        ollama_messages = messages
         
-        print(f"🔵 [OLLAMA] Calling Ollama with {len(ollama_messages)} messages")
-        print(f"🔵 [OLLAMA] Last message: {ollama_messages[-1] if ollama_messages else 'None'}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔵 [OLLAMA] Last message: %s", ollama_messages[-1] if ollama_messages else None)
         
         # Stream from Ollama
-        full_response = ""
+        parts: List[str] = []
+        total_length = 0
         chunk_count = 0
-        stream = ollama.chat(
-            model=model,
-            messages=ollama_messages,
-            stream=True,
-        )
-        
-        print(f"🟢 [OLLAMA] Stream started successfully")
-        
-        for chunk in stream:
-            chunk_count += 1
-            if 'message' in chunk and 'content' in chunk['message']:
-                content = chunk['message']['content']
-                full_response += content
-                
-                if chunk_count <= 3 or chunk_count % 10 == 0:
-                    print(f"📝 [CHUNK {chunk_count}] Received: {content[:50]}...")
-                
-                # Send text message event for each chunk
-                event = create_agui_event(EventType.TEXT_MESSAGE, {
-                    "content": content,
-                    "delta": True,
-                    "role": "assistant"
-                })
-                yield event
-        
-        print(f"✅ [STREAM] Received {chunk_count} chunks, total length: {len(full_response)}")
+        async with _OLLAMA_SEM:
+            stream = await _client.chat(
+                model=model,
+                messages=ollama_messages,
+                stream=True,
+            )
+            
+            logger.debug("🟢 [OLLAMA] Stream started successfully")
+            
+            # Coalesce tokens into one text_message event per batch. The next
+            # chunk is read as a task so a timeout flushes the buffer without
+            # cancelling the read from Ollama.
+            loop = asyncio.get_running_loop()
+            flush_deadline = 0.0
+            chunks = aiter(stream)
+            pending = None
+            
+            try:
+                while True:
+                    if pending is None:
+                        pending = asyncio.ensure_future(anext(chunks))
+                    timeout = max(0.0, flush_deadline - loop.time()) if buf else None
+                    done, _ = await asyncio.wait({pending}, timeout=timeout)
+                    if not done:
+                        # Oldest buffered token has waited COALESCE_MAX_DELAY
+                        yield _text_message_event(buf)
+                        buf.clear()
+                        continue
+                    
+                    try:
+                        chunk = pending.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        pending = None
+                    
+                    chunk_count += 1
+                    if 'message' in chunk and 'content' in chunk['message']:
+                        content = chunk['message']['content']
+                        total_length += len(content)
+                        if include_result:
+                            parts.append(content)
+                        if not buf:
+                            flush_deadline = loop.time() + COALESCE_MAX_DELAY
+                        buf.append(content)
+                        
+                        if logger.isEnabledFor(logging.DEBUG) and (chunk_count <= 3 or chunk_count % 10 == 0):
+                            logger.debug("📝 [CHUNK %d] Received: %s...", chunk_count, content[:50])
+                        
+                        if len(buf) >= COALESCE_MAX_TOKENS:
+                            yield _text_message_event(buf)
+                            buf.clear()
+            finally:
+                if pending is not None:
+                    pending.cancel()
+            
+            # Flush whatever is left once Ollama finishes
+            if buf:
+                yield _text_message_event(buf)
+            
+        logger.info("✅ [STREAM] Received %d chunks, total length: %d", chunk_count, total_length)
         
         # Send result event with full response
-        result_event = create_agui_event(EventType.RESULT, {
-            "content": full_response,
-            "role": "assistant",
-            "model": model
-        })
-        print(f"📤 [EVENT] Sending RESULT event with {len(full_response)} chars")
-        yield result_event
+        if include_result:
+            full_response = "".join(parts)
+            result_event = create_agui_event(EventType.RESULT, {
+                "content": full_response,
+                "role": "assistant",
+                "model": model
+            })
+            logger.debug("📤 [EVENT] Sending RESULT event with %d chars", len(full_response))
+            yield result_event
         
         # Send end event
         end_event = create_agui_event(EventType.END, {
             "status": "completed",
-            "message_count": len(full_response)
+            "message_count": total_length
         })
-        print(f"📤 [EVENT] Sending END event")
+        logger.debug("📤 [EVENT] Sending END event")
         yield end_event
         
     except Exception as e:
-        print(f"❌ [ERROR] Exception in stream: {str(e)}")
-        print(f"❌ [ERROR] Exception type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ [ERROR] Exception in stream (%s): %s", type(e).__name__, e)
+        
+        # Deliver any buffered tokens before reporting the failure
+        if buf:
+            yield _text_message_event(buf)
+            buf.clear()
         
         # Send error event
         error_event = create_agui_event(EventType.ERROR, {
             "error": str(e),
             "message": "Failed to generate response from Ollama"
         })
-        print(f"📤 [EVENT] Sending ERROR event")
+        logger.debug("📤 [EVENT] Sending ERROR event")
         yield error_event
 
 @app.get("/")
@@ -242,17 +384,49 @@ async def root():
         "model": "mistral:latest"
     }
 
+# Successful /health results are reused briefly so frequent probes don't hit Ollama
+HEALTH_CACHE_TTL = 2.0
+# Upper bound on one Ollama probe; the shared client has no read timeout
+HEALTH_CHECK_TIMEOUT = 3.0
+_health_cache = {"t": 0.0, "v": None}
+# In-flight refresh shared by all concurrent /health callers
+_health_refresh: Optional[asyncio.Task] = None
+
+def _cached_health() -> Optional[dict]:
+    """Return the last healthy result if it is still fresh"""
+    if _health_cache["v"] is not None and time.monotonic() - _health_cache["t"] < HEALTH_CACHE_TTL:
+        return _health_cache["v"]
+    return None
+
+async def _refresh_health() -> dict:
+    """List Ollama models once, bounded by HEALTH_CHECK_TIMEOUT, and cache the result"""
+    models = await asyncio.wait_for(_client.list(), timeout=HEALTH_CHECK_TIMEOUT)
+    _health_cache["v"] = {
+        "status": "healthy",
+        "ollama": "connected",
+        "available_models": [model['name'] for model in models.get('models', [])]
+    }
+    _health_cache["t"] = time.monotonic()
+    return _health_cache["v"]
+
 @app.get("/health")
 async def health_check():
     """Check if Ollama is accessible"""
+    global _health_refresh
+    if (cached := _cached_health()) is not None:
+        return cached
+    # Join the refresh already in flight, or start one; either way a caller
+    # waits at most HEALTH_CHECK_TIMEOUT, and failures are shared too
+    if _health_refresh is None or _health_refresh.done():
+        _health_refresh = asyncio.ensure_future(_refresh_health())
     try:
-        # Try to list models to verify Ollama connection
-        models = ollama.list()
-        return {
-            "status": "healthy",
-            "ollama": "connected",
-            "available_models": [model['name'] for model in models.get('models', [])]
-        }
+        # Shield so a disconnecting caller doesn't cancel the shared refresh
+        return await asyncio.shield(_health_refresh)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Ollama not accessible: no response within {HEALTH_CHECK_TIMEOUT}s"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=503,
@@ -260,31 +434,31 @@ async def health_check():
         )
 
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, final: bool = True):
     """
     AG-UI compliant chat endpoint with streaming
     Streams events using Server-Sent Events (SSE)
+    Pass ?final=0 to skip the final RESULT event
     """
-    print(f"\n{'='*60}")
-    print(f"🌐 [CHAT] Received /chat request")
-    print(f"🌐 [CHAT] Messages: {len(request.messages)}")
-    print(f"🌐 [CHAT] Model: {request.model}")
-    for i, msg in enumerate(request.messages):
-        print(f"  📨 Message {i+1}: [{msg.role}] {msg.content[:100]}...")
-    print(f"{'='*60}\n")
+    logger.info("🌐 [CHAT] chat request model=%s n_messages=%d", request.model, len(request.messages))
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, msg in enumerate(request.messages):
+            logger.debug("  📨 Message %d: [%s] %s...", i + 1, msg["role"], msg["content"][:100])
     
     try:
         return StreamingResponse(
-            stream_ollama_response(request.messages, request.model),
-            media_type="text/event-stream",
+            stream_ollama_response(request.messages, request.model, include_result=final),
+            media_type="text/event-stream; charset=utf-8",
             headers={
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"
+                "X-Accel-Buffering": "no",
+                # Stop intermediaries from gzip-buffering the token stream
+                "Content-Encoding": "identity"
             }
         )
     except Exception as e:
-        print(f"❌ [CHAT] Error: {str(e)}")
+        logger.error("❌ [CHAT] Error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Error processing chat request: {str(e)}"
@@ -297,4 +471,16 @@ if __name__ == "__main__":
     print("🤖 Model: Ollama (mistral:latest)")
     print("🌐 Server: http://localhost:8000")
     print("📚 Docs: http://localhost:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+
+    # Prefer io_uring-backed loop on Linux when uringcore is installed,
+    # otherwise let uvicorn pick uvloop when available ("auto")
+    loop = "auto"
+    if sys.platform == "linux":
+        try:
+            import uringcore
+            asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+            loop = "none"
+        except ImportError:
+            pass
+
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info", loop=loop, http="httptools")